@@ -0,0 +1,3 @@
+from librarian.cmd import librarian_command_line
+
+librarian_command_line()
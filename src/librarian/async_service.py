@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+from librarian.exceptions import OperationCancelledException
+from librarian.lock import cancel_lock_waits
+from librarian.service import LibraryService
+
+logger = logging.getLogger(__name__)
+
+# progress callback: (number of files handled so far, path of current file).
+ProgressCallback = Callable[[int, str], None]
+
+class AsyncLibraryService:
+    """Awaitable wrapper around `LibraryService`.
+
+    Blocking I/O runs in an executor. Progress callbacks are called on the event
+    loop thread, so they can update a UI directly. Cancelling an awaited
+    operation stops it at the next file, or while it waits for a lock held by
+    another process. A cancelled push, pull or copy leaves
+    the destination as it was; a cancelled sync keeps the files synced so far.
+    """
+
+    def __init__(self, service:LibraryService, executor:Executor=None):
+        self.service = service
+        self.executor = executor if executor is not None else ThreadPoolExecutor()
+
+    async def _run(self, func, *args, progress:ProgressCallback=None, **kwargs):
+        loop = asyncio.get_running_loop()
+        cancel_event = threading.Event()
+        count = 0
+
+        def on_file(path):
+            nonlocal count
+            if cancel_event.is_set():
+                raise OperationCancelledException()
+            count += 1
+            if progress is not None:
+                loop.call_soon_threadsafe(progress, count, path)
+
+        def call():
+            with cancel_lock_waits(cancel_event):
+                return func(*args, on_file=on_file, **kwargs)
+
+        future = loop.run_in_executor(self.executor, call)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # stop the worker and wait until it has cleaned up before propagating.
+            cancel_event.set()
+            try:
+                await future
+            except OperationCancelledException:
+                pass
+            raise
+
+    async def run(self, func, *args, progress:ProgressCallback=None, **kwargs):
+        # run a blocking function that takes an `on_file` callback like the service methods.
+        return await self._run(func, *args, progress=progress, **kwargs)
+
+    async def _run_blocking(self, func, *args, **kwargs):
+        # cancelling only stops waiting for locks, an operation that already runs finishes in the background.
+        loop = asyncio.get_running_loop()
+        cancel_event = threading.Event()
+
+        def call():
+            with cancel_lock_waits(cancel_event):
+                return func(*args, **kwargs)
+
+        try:
+            return await loop.run_in_executor(self.executor, call)
+        except asyncio.CancelledError:
+            cancel_event.set()
+            raise
+
+    # get
+    async def is_project(self, project_name:str) -> bool:
+        return await self._run_blocking(self.service.is_project, project_name)
+
+    async def list_projects(self, pattern=None) -> List[str]:
+        return await self._run_blocking(self.service.list_projects, pattern=pattern)
+
+    # create
+    async def create_project(self, project_name:str, source_project_path=None, progress:ProgressCallback=None):
+        await self._run(self.service.create_project, project_name, source_project_path=source_project_path, progress=progress)
+
+    async def copy_project(self, source_project_name, destination_project_name:str=None, overwrite:bool=False, progress:ProgressCallback=None) -> str:
+        return await self._run(self.service.copy_project, source_project_name, destination_project_name, overwrite=overwrite, progress=progress)
+
+    # update
+    async def pull_project(self, from_project_name, progress:ProgressCallback=None):
+        await self._run(self.service.pull_project, from_project_name, progress=progress)
+
+    async def push_project(self, to_project_name, progress:ProgressCallback=None):
+        await self._run(self.service.push_project, to_project_name, progress=progress)
+
+    async def sync(self, project_name, previous_state:Dict=None, last_sync_time=None, progress:ProgressCallback=None) -> Dict:
+        return await self._run(self.service.sync, project_name, previous_state=previous_state, last_sync_time=last_sync_time, progress=progress)
+
+    async def stage_project(self, project_name, progress:ProgressCallback=None):
+        await self._run(self.service.stage_project, project_name, progress=progress)
+
+    async def verify(self, project_name, max_workers:int=None) -> List[Tuple[str, str]]:
+        return await self._run_blocking(self.service.verify, project_name, max_workers=max_workers)
+
+    # delete (not cancellable once started)
+    async def delete_project(self, project_name):
+        await asyncio.shield(self._run_blocking(self.service.delete_project, project_name))
+
+    async def delete_projects(self, project_names:List[str]):
+        await asyncio.shield(self._run_blocking(self.service.delete_projects, project_names))
+
+    def clear_cache(self):
+        self.service.clear_cache()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -1,8 +1,10 @@
 import argparse
 import os
 import logging
+import sys
 
-from librarian.controller import LibrarianController
+from librarian.controller import LibrarianController, LIBRARIAN_FILEPATH
+from librarian.daemon import DEFAULT_HOST, DEFAULT_PORT
 
 logger = logging.getLogger(__name__)
 
@@ -11,6 +13,8 @@ def librarian_command_line():
     parser = argparse.ArgumentParser()
     parser.add_argument('--library', type=str, help='specify path to library')
     parser.add_argument('--workspace', type=str, help='specify path to workspace')
+    parser.add_argument('--workspace-name', type=str, help='specify name of workspace (default workspace if omitted)')
+    parser.add_argument('--config', type=str, help='specify path to librarian data', default=LIBRARIAN_FILEPATH)
     parser.add_argument('--log', type=str, help='specify logging level', default='info')
     parser.add_argument('--sync_targets', nargs='+', default=[])
 
@@ -32,17 +36,41 @@ def librarian_command_line():
 
     pull_parser = subparsers.add_parser('pull', help='Load linked project from library.')
 
+    prepare_parser = subparsers.add_parser('prepare', help='Stage a project in the background so loading it is fast.')
+    prepare_parser.add_argument('project_name', type=str)
+    prepare_parser.add_argument('--foreground', action='store_true', help='Stage in this process instead.')
+
     load_parser = subparsers.add_parser('load', help='Load project from library.')
     load_parser.add_argument('project_name', type=str)
 
     push_parser = subparsers.add_parser('push', help='Save current project to library.')
 
+    filter_parser = subparsers.add_parser('filter', help='Show or set gitignore-style filters of a sync target.')
+    filter_parser.add_argument('sync_target', type=str, nargs='?')
+    filter_parser.add_argument('-i', '--include', type=str, nargs='+', default=[], help='Only sync files matching these patterns.')
+    filter_parser.add_argument('-e', '--exclude', type=str, nargs='+', default=[], help='Never scan, copy or sync paths matching these patterns.')
+    filter_parser.add_argument('--clear', action='store_true', help='Remove existing patterns first.')
+
+    verify_parser = subparsers.add_parser('verify', help='Verify that workspace and library files match.')
+    verify_parser.add_argument('project_name', type=str, nargs='?', help='project to compare with (assigned project if omitted)')
+
     sync_parser = subparsers.add_parser('sync', help='Sync current project with library.')
+    sync_parser.add_argument('-w', '--workspaces', type=str, nargs='+', default=[], help='Sync the given workspaces in parallel.')
+    sync_parser.add_argument('--all', action='store_true', help='Sync all workspaces in parallel.')
+    sync_parser.add_argument('-j', '--jobs', type=int, help='Maximum number of workspaces synced at once.')
+
+    workspace_parser = subparsers.add_parser('workspace', help='Manage named workspaces.')
+    workspace_parser.add_argument('action', choices=['list', 'default', 'remove'], nargs='?', default='list')
+    workspace_parser.add_argument('workspace_name', type=str, nargs='?')
 
     delete_parser = subparsers.add_parser('delete', help='Delete a project or multiple projects.')
     delete_parser.add_argument('-n', '--names', type=str, nargs="+", default=[])
     delete_parser.add_argument('-p', '--pattern', type=str)
 
+    daemon_parser = subparsers.add_parser('daemon', help='Serve library operations from a long-running process.')
+    daemon_parser.add_argument('--host', type=str, default=DEFAULT_HOST, help='loopback address to listen on')
+    daemon_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+
     parser.set_defaults()
     args = parser.parse_args()
     command = args.command
@@ -69,7 +97,13 @@ def librarian_command_line():
     if isinstance(workspace_path, str) and not os.path.exists(workspace_path):
         raise FileNotFoundError(workspace_path)
 
-    controller = LibrarianController(library_path=library_path, workspace_path=workspace_path, sync_targets=sync_targets)
+    controller = LibrarianController(
+        library_path=library_path,
+        workspace_path=workspace_path,
+        sync_targets=sync_targets,
+        workspace_name=args.workspace_name,
+        metadata_path=args.config,
+    )
 
     if command == 'create':
         controller.create(args.project_name)
@@ -86,12 +120,30 @@ def librarian_command_line():
 
     if command == 'pull':
         controller.pull()
+
+    if command == 'prepare':
+        controller.prepare(args.project_name, background=not args.foreground)
     
     if command == 'push':
         controller.push()
 
     if command == 'sync':
-        controller.sync()
+        if args.all:
+            controller.sync_workspaces(list(controller.workspaces), max_workers=args.jobs)
+        elif args.workspaces:
+            controller.sync_workspaces(args.workspaces, max_workers=args.jobs)
+        else:
+            controller.sync()
+
+    if command == 'workspace':
+        if args.action == 'list':
+            controller.list_workspaces()
+        elif args.workspace_name is None:
+            parser.error(f"workspace {args.action} requires a workspace name")
+        elif args.action == 'default':
+            controller.set_default_workspace(args.workspace_name)
+        elif args.action == 'remove':
+            controller.remove_workspace(args.workspace_name)
 
     if command == 'load':
         controller.load_project(args.project_name)
@@ -102,8 +154,24 @@ def librarian_command_line():
     if args.command == 'delete':
         controller.delete_projects(args.names, args.pattern)
 
+    if command == 'filter':
+        if args.sync_target is None:
+            controller.list_filters()
+        else:
+            controller.set_filter(args.sync_target, include=args.include, exclude=args.exclude, clear=args.clear)
+
+    verified = True
+    if command == 'verify':
+        verified = controller.verify(args.project_name)
+
+    if command == 'daemon':
+        controller.serve(args.host, args.port)
+
     if args.command is None:
         controller.display_status()
 
     controller.update_sync_state()
-    controller.update_metadata()
\ No newline at end of file
+    controller.update_metadata()
+
+    if not verified:
+        sys.exit(1)
\ No newline at end of file
@@ -1,12 +1,25 @@
+import asyncio
+import copy
 import logging
 import os
+import shutil
+import subprocess
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, List, Optional
 import yaml
-from librarian.exceptions import FolderCollisionException, InvalidProjectException
+from librarian.exceptions import FolderCollisionException, InvalidPatternException, InvalidProjectException, InvalidWorkspaceException
 
+from librarian.async_service import AsyncLibraryService
+from librarian.daemon import LibrarianDaemon
+from librarian.lock import FileLock
 from librarian.service import LibraryService
 
 LIBRARIAN_FILEPATH = "librarian.yaml"
+METADATA_LOCK_TIMEOUT = 30
+DEFAULT_WORKSPACE_NAME = 'default'
 
 LIBRARY_PATH_KEY = 'library-path'
 WORKSPACE_PATH_KEY = 'workspace-path'
@@ -14,8 +27,13 @@ CURRENT_PROJECT_KEY = 'current-project'
 CREATE_TIME_KEY = 'create-time'
 MODIFY_TIME_KEY = 'modify-time'
 SYNC_TARGET_KEY = 'sync-targets'
+SYNC_FILTERS_KEY = 'sync-filters'
+INCLUDE_KEY = 'include'
+EXCLUDE_KEY = 'exclude'
 LAST_SYNC_TIME_KEY = 'last-sync-time'
 SYNC_STATE_KEY = 'sync-state'
+WORKSPACES_KEY = 'workspaces'
+DEFAULT_WORKSPACE_KEY = 'default-workspace'
 
 logger = logging.getLogger(__name__)
 
@@ -51,43 +69,130 @@ def get_path(role) -> str:
         retry_times += 1
     raise KeyboardInterrupt("Quitting process due to multiple invalid arguments.")
 
+def spawn_background(args:List[str], log_path:str):
+    # run a librarian command detached from this process at the lowest priority.
+    kwargs = dict()
+    if os.name == "nt":
+        kwargs["creationflags"] = subprocess.IDLE_PRIORITY_CLASS | subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs["start_new_session"] = True
+        kwargs["preexec_fn"] = lambda: os.nice(19)
+        if shutil.which("ionice") is not None:
+            # idle I/O scheduling class.
+            args = ["ionice", "-c", "3"] + args
+    with open(log_path, "w") as log:
+        subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, **kwargs)
+
+def read_metadata(metadata_path) -> Optional[Dict]:
+    if not os.path.exists(metadata_path):
+        return None
+    with open(metadata_path, "r") as reader:
+        return yaml.safe_load(reader) or dict()
+
+def get_workspaces(data:Dict) -> Dict[str, Dict]:
+    # workspaces from librarian data (metadata with a single workspace is read as the default workspace).
+    workspaces = data.get(WORKSPACES_KEY)
+    if workspaces is not None:
+        return workspaces
+    if data.get(WORKSPACE_PATH_KEY) is None:
+        return dict()
+    return {
+        DEFAULT_WORKSPACE_NAME: {
+            WORKSPACE_PATH_KEY: data.get(WORKSPACE_PATH_KEY),
+            CURRENT_PROJECT_KEY: data.get(CURRENT_PROJECT_KEY),
+            LAST_SYNC_TIME_KEY: data.get(LAST_SYNC_TIME_KEY),
+            SYNC_STATE_KEY: data.get(SYNC_STATE_KEY),
+        }
+    }
+
+@contextmanager
+def edit_metadata(metadata_path):
+    # read-modify-write librarian data while holding the metadata lock.
+    with FileLock(metadata_path + ".lock", timeout=METADATA_LOCK_TIMEOUT):
+        data = read_metadata(metadata_path)
+        if data is None:
+            data = dict()
+        yield data
+        if WORKSPACES_KEY not in data:
+            data[WORKSPACES_KEY] = get_workspaces(data)
+        for key in (WORKSPACE_PATH_KEY, CURRENT_PROJECT_KEY, LAST_SYNC_TIME_KEY, SYNC_STATE_KEY):
+            data.pop(key, None)
+
+        # write to temporary file first so readers never see partial metadata.
+        temp_path = metadata_path + ".tmp"
+        with open(temp_path, "w") as writer:
+            yaml.safe_dump(data, writer)
+        os.replace(temp_path, metadata_path)
+
 class LibrarianController:
 
-    def __init__(self, library_path=None, workspace_path=None, sync_targets=None):
-        if os.path.exists(LIBRARIAN_FILEPATH):
-            with open(LIBRARIAN_FILEPATH, "r") as reader:
-                data = yaml.safe_load(reader)
-                self.library_path = data.get(LIBRARY_PATH_KEY)
-                self.workspace_path = data.get(WORKSPACE_PATH_KEY)
-                self.current_project = data.get(CURRENT_PROJECT_KEY)
-                self.create_time = data.get(CREATE_TIME_KEY)
-                self.modify_time = data.get(MODIFY_TIME_KEY)
-                self.sync_targets = data.get(SYNC_TARGET_KEY)
-                self.last_sync_time = data.get(LAST_SYNC_TIME_KEY)
-                self.sync_state = data.get(SYNC_STATE_KEY)
+    def __init__(self, library_path=None, workspace_path=None, sync_targets=None, workspace_name=None, metadata_path=LIBRARIAN_FILEPATH):
+        self.metadata_path = metadata_path
+        with FileLock(metadata_path + ".lock", timeout=METADATA_LOCK_TIMEOUT):
+            data = read_metadata(metadata_path)
+        if data is not None:
+            self.library_path = data.get(LIBRARY_PATH_KEY)
+            self.create_time = data.get(CREATE_TIME_KEY)
+            self.modify_time = data.get(MODIFY_TIME_KEY)
+            self.sync_targets = data.get(SYNC_TARGET_KEY)
+            self.sync_filters = data.get(SYNC_FILTERS_KEY) or dict()
+            self.workspaces = get_workspaces(data)
+            self.default_workspace = data.get(DEFAULT_WORKSPACE_KEY)
+            if self.default_workspace not in self.workspaces:
+                self.default_workspace = next(iter(self.workspaces), None)
             print("Retrieved Librarian data.")
         else:
             # user inputs here.
             if library_path is None:
                 library_path = get_path("library")
-            if workspace_path is None:
-                workspace_path = get_path("workspace")
-            if library_path == workspace_path:
-                raise FolderCollisionException()
             print("Initialized Librarian data.")
             if sync_targets is None or len(sync_targets) == 0:
                 sync_targets = ['UserData']
 
             self.library_path = library_path
-            self.workspace_path = workspace_path
-            self.current_project = None
             self.create_time = time.time()
             self.modify_time = self.create_time
             self.sync_targets = sync_targets
-            self.last_sync_time = time.time()
-            self.sync_state = None
-        
-        self.service = LibraryService(self.library_path, self.workspace_path, self.sync_targets)
+            self.sync_filters = dict()
+            self.workspaces = dict()
+            self.default_workspace = None
+
+        if workspace_name is None:
+            workspace_name = self.default_workspace or DEFAULT_WORKSPACE_NAME
+        if workspace_name not in self.workspaces:
+            self._add_workspace(workspace_name, workspace_path)
+        if self.default_workspace is None:
+            self.default_workspace = workspace_name
+        self._select_workspace(workspace_name)
+
+    def _add_workspace(self, workspace_name, workspace_path=None):
+        # user inputs here.
+        if workspace_path is None:
+            workspace_path = get_path(f"workspace \"{workspace_name}\"")
+        if os.path.realpath(workspace_path) == os.path.realpath(self.library_path):
+            raise FolderCollisionException()
+        for name, workspace in self.workspaces.items():
+            if os.path.realpath(workspace[WORKSPACE_PATH_KEY]) == os.path.realpath(workspace_path):
+                raise FolderCollisionException(f"Workspace {name} is already assigned to this directory.")
+        self.workspaces[workspace_name] = {
+            WORKSPACE_PATH_KEY: workspace_path,
+            CURRENT_PROJECT_KEY: None,
+            LAST_SYNC_TIME_KEY: time.time(),
+            SYNC_STATE_KEY: None,
+        }
+        print(f"Added workspace {workspace_name}.")
+
+    def _select_workspace(self, workspace_name):
+        if workspace_name not in self.workspaces:
+            raise InvalidWorkspaceException(workspace_name)
+        workspace = self.workspaces[workspace_name]
+        self.workspace_name = workspace_name
+        self.workspace_path = workspace.get(WORKSPACE_PATH_KEY)
+        self.current_project = workspace.get(CURRENT_PROJECT_KEY)
+        self._selected_project = self.current_project
+        self.last_sync_time = workspace.get(LAST_SYNC_TIME_KEY)
+        self.sync_state = workspace.get(SYNC_STATE_KEY)
+        self.service = LibraryService(self.library_path, self.workspace_path, self.sync_targets, sync_filters=self.sync_filters)
 
     @spacing
     def display_status(self):
@@ -99,20 +204,141 @@ class LibrarianController:
             print("There is no current project assigned.")
             return
         print(f"Current project: {current_project}")
+        staged_project = self.service.staged_project()
+        if staged_project is not None:
+            print(f"Prepared project: {staged_project}")
+
+    @spacing
+    def list_workspaces(self):
+        for name, workspace in sorted(self.workspaces.items()):
+            default = " (default)" if name == self.default_workspace else ""
+            print(f"- {name}{default}: {workspace.get(WORKSPACE_PATH_KEY)} -> {workspace.get(CURRENT_PROJECT_KEY)}")
+
+    def set_default_workspace(self, workspace_name):
+        if workspace_name not in self.workspaces:
+            raise InvalidWorkspaceException(workspace_name)
+        self.default_workspace = workspace_name
+        with edit_metadata(self.metadata_path) as data:
+            data[DEFAULT_WORKSPACE_KEY] = workspace_name
+        print(f"Default workspace set to {workspace_name}.")
+
+    def remove_workspace(self, workspace_name):
+        if workspace_name not in self.workspaces:
+            raise InvalidWorkspaceException(workspace_name)
+        if workspace_name == self.workspace_name:
+            print(f"Cannot remove the selected workspace {workspace_name}, select another with --workspace-name.")
+            return
+        del self.workspaces[workspace_name]
+        if self.default_workspace == workspace_name:
+            self.default_workspace = self.workspace_name
+        with edit_metadata(self.metadata_path) as data:
+            workspaces = get_workspaces(data)
+            workspaces.pop(workspace_name, None)
+            data[WORKSPACES_KEY] = workspaces
+            if data.get(DEFAULT_WORKSPACE_KEY) == workspace_name:
+                data[DEFAULT_WORKSPACE_KEY] = self.default_workspace
+        print(f"Removed workspace {workspace_name}.")
+
+    @spacing
+    def list_filters(self):
+        if not self.sync_filters:
+            print("No sync filters.")
+        for target, patterns in sorted(self.sync_filters.items()):
+            print(f"{target}:")
+            for pattern in patterns.get(INCLUDE_KEY) or []:
+                print(f"  include {pattern}")
+            for pattern in patterns.get(EXCLUDE_KEY) or []:
+                print(f"  exclude {pattern}")
+
+    def set_filter(self, sync_target, include=None, exclude=None, clear=False):
+        # add gitignore-style include/exclude patterns to a sync target.
+        if sync_target not in self.sync_targets:
+            print(f"{sync_target} is not a sync target ({', '.join(self.sync_targets)}).")
+            return
+        patterns = dict() if clear else dict(self.sync_filters.get(sync_target, dict()))
+        patterns[INCLUDE_KEY] = (patterns.get(INCLUDE_KEY) or []) + (include or [])
+        patterns[EXCLUDE_KEY] = (patterns.get(EXCLUDE_KEY) or []) + (exclude or [])
+        sync_filters = dict(self.sync_filters)
+        if patterns[INCLUDE_KEY] or patterns[EXCLUDE_KEY]:
+            sync_filters[sync_target] = patterns
+        else:
+            sync_filters.pop(sync_target, None)
+
+        # check patterns before they are saved.
+        try:
+            service = LibraryService(self.library_path, self.workspace_path, self.sync_targets, sync_filters=sync_filters)
+        except InvalidPatternException as e:
+            print(e)
+            return
+        self.sync_filters = sync_filters
+        self.service = service
+        with edit_metadata(self.metadata_path) as data:
+            data[SYNC_FILTERS_KEY] = self.sync_filters
+        print(f"Updated sync filters of {sync_target}.")
 
     def update_metadata(self):
-        # update librarian data
-        with open(LIBRARIAN_FILEPATH, "w") as writer:
-            yaml.safe_dump({
+        # update librarian data (entries of other workspaces are kept as stored).
+        with edit_metadata(self.metadata_path) as data:
+            data.update({
                 LIBRARY_PATH_KEY: self.library_path,
-                WORKSPACE_PATH_KEY: self.workspace_path,
-                CURRENT_PROJECT_KEY: self.current_project,
                 CREATE_TIME_KEY: self.create_time,
                 MODIFY_TIME_KEY: time.time(),
                 SYNC_TARGET_KEY: self.sync_targets,
-                SYNC_STATE_KEY: self.sync_state,
+            })
+            workspaces = get_workspaces(data)
+            workspace = workspaces.setdefault(self.workspace_name, {
+                CURRENT_PROJECT_KEY: self.current_project,
                 LAST_SYNC_TIME_KEY: self.last_sync_time,
-            }, writer)
+                SYNC_STATE_KEY: self.sync_state,
+            })
+            # only write what this process changed, so concurrent processes don't revert each other.
+            # (sync state is written by sync() itself.)
+            workspace[WORKSPACE_PATH_KEY] = self.workspace_path
+            if self.current_project != self._selected_project:
+                workspace[CURRENT_PROJECT_KEY] = self.current_project
+            data[WORKSPACES_KEY] = workspaces
+            if data.get(DEFAULT_WORKSPACE_KEY) not in workspaces:
+                data[DEFAULT_WORKSPACE_KEY] = self.default_workspace
+        self.workspaces[self.workspace_name] = workspace
+
+    def _update_sync_state(self):
+        with edit_metadata(self.metadata_path) as data:
+            workspaces = get_workspaces(data)
+            workspace = workspaces.setdefault(self.workspace_name, {
+                WORKSPACE_PATH_KEY: self.workspace_path,
+                CURRENT_PROJECT_KEY: self.current_project,
+            })
+            workspace[LAST_SYNC_TIME_KEY] = self.last_sync_time
+            workspace[SYNC_STATE_KEY] = self.sync_state
+            data[WORKSPACES_KEY] = workspaces
+
+    def _assignment_changed(self) -> bool:
+        # call with the workspace lock held: another process may have assigned a project since startup.
+        stored_project = self._stored_workspace().get(CURRENT_PROJECT_KEY)
+        if stored_project == self.current_project:
+            return False
+        print(f"{stored_project} was assigned to current project by another process, cancelling.")
+        return True
+
+    def _store_assignment(self):
+        # call with the workspace lock held, so syncs never see the workspace files of another project.
+        # the sync state belonged to the previous project and starts over.
+        self.sync_state = None
+        self.last_sync_time = time.time()
+        self.update_metadata()
+        self._selected_project = self.current_project
+        self._update_sync_state()
+
+    def _switch_project(self, project_name, save_changes:bool=False):
+        # push, pull and the new assignment happen under one workspace lock.
+        with self.service.workspace_lock():
+            if self._assignment_changed():
+                return
+            if save_changes and self.current_project is not None:
+                self.service.push_project(self.current_project)
+            self._assign_project(project_name)
+            self.service.pull_project(project_name)
+            self._store_assignment()
 
     def _unassign_project(self):
         if self.current_project is None:
@@ -135,13 +361,19 @@ class LibrarianController:
 
     # actions
     def create(self, project_name):
-        self.service.create_project(project_name)
-        self._assign_project(project_name)
+        with self.service.workspace_lock():
+            self.service.create_project(project_name)
+            self._assign_project(project_name)
+            self._store_assignment()
 
     def copy_full(self, source_project_name, destination_project_name):
-        destination_project_name = self.service.copy_project(source_project_name, destination_project_name)
-        if destination_project_name is None:
-            return
+        overwrite = False
+        if self.service.is_project(destination_project_name) and destination_project_name != source_project_name:
+            confirmation = input("A project already exists with this name. Override? (y/n): ")
+            if confirmation != "y":
+                return
+            overwrite = True
+        destination_project_name = self.service.copy_project(source_project_name, destination_project_name, overwrite=overwrite)
         print(f"Copied project {source_project_name} to {destination_project_name}")
 
     def copy_relative(self, source_project_name, destination_project_name):
@@ -207,49 +439,120 @@ class LibrarianController:
                 return
             
             save_changes = True if save_changes.lower() == "y" else False
-        if save_changes:
-            self.push()
-        self._assign_project(project_name)
-        self.pull()
+        self._switch_project(project_name, save_changes=save_changes)
+
+    def prepare(self, project_name, background=True):
+        if not self.service.is_project(project_name):
+            raise InvalidProjectException(project_name)
+        if project_name == self.current_project:
+            print(f"{project_name} is already assigned to current project.")
+            return
+        if not background:
+            self.service.stage_project(project_name)
+            print(f"Prepared {project_name}.")
+            return
+        spawn_background([
+            sys.executable, "-m", "librarian",
+            "--config", os.path.abspath(self.metadata_path),
+            "--workspace-name", self.workspace_name,
+            "prepare", "--foreground", project_name,
+        ], log_path=self.service.staging_path() + ".log")
+        print(f"Preparing {project_name} in the background.")
 
     def pull(self):
         if self.current_project is not None:
-            self.service.pull_project(self.current_project)
+            with self.service.workspace_lock():
+                if not self._assignment_changed():
+                    self.service.pull_project(self.current_project)
         else:
             print(f"No assigned project to pull from.")
 
     def push(self):
         if self.current_project is not None:
-            self.service.push_project(self.current_project)
+            with self.service.workspace_lock():
+                if not self._assignment_changed():
+                    self.service.push_project(self.current_project)
         else:
             print(f"No assigned project to push to.")
 
+    def verify(self, project_name=None) -> bool:
+        if project_name is None:
+            project_name = self.current_project
+        if project_name is None:
+            print(f"No assigned project to verify.")
+            return False
+        mismatches = self.service.verify(project_name)
+        if not mismatches:
+            print(f"Workspace matches {project_name}.")
+            return True
+
+        @spacing
+        def display():
+            for path, reason in mismatches:
+                print(f"- {path}: {reason}")
+        print(f"Found {len(mismatches)} mismatches with {project_name}.")
+        display()
+        return False
+
     def update_sync_state(self):
         # new_sync_state = self.service.get_sync_state()
         # self.sync_state = new_sync_state
         pass
 
-    def sync(self):
-        if self.current_project is not None:
-            previous_state = self.sync_state
-            last_sync_time = self.last_sync_time
-            new_sync_state = self.service.sync(self.current_project, previous_state=previous_state, last_sync_time=last_sync_time)
+    def _stored_workspace(self) -> Dict:
+        return get_workspaces(read_metadata(self.metadata_path) or dict()).get(self.workspace_name, dict())
+
+    def sync(self, on_file=None, follow_assignment:bool=False) -> Optional[Dict]:
+        # with `follow_assignment` the stored assignment is synced, otherwise the sync is skipped if it changed.
+        with self.service.workspace_lock():
+            # reload assignment and sync state in case another process changed them since startup.
+            workspace = self._stored_workspace()
+            if follow_assignment:
+                self.current_project = workspace.get(CURRENT_PROJECT_KEY)
+                self._selected_project = self.current_project
+            elif self._assignment_changed():
+                return None
+            if self.current_project is None:
+                print(f"No assigned project to sync with.")
+                return None
+            previous_state = workspace.get(SYNC_STATE_KEY, self.sync_state)
+            last_sync_time = workspace.get(LAST_SYNC_TIME_KEY, self.last_sync_time)
+            new_sync_state = self.service.sync(self.current_project, previous_state=previous_state, last_sync_time=last_sync_time, on_file=on_file)
             self.sync_state = new_sync_state
             self.last_sync_time = time.time()
-        else:
-            print(f"No assigned project to sync with.")
+            self._update_sync_state()
+        return new_sync_state
+
+    def sync_assigned(self, on_file=None) -> Optional[Dict]:
+        # sync for long-running processes: the assignment may have changed since startup.
+        return self.sync(on_file=on_file, follow_assignment=True)
+
+    def sync_workspaces(self, workspace_names:List[str], max_workers:int=None):
+        # sync several workspaces with their assigned projects in parallel.
+        for name in workspace_names:
+            if name not in self.workspaces:
+                raise InvalidWorkspaceException(name)
+
+        def sync_workspace(name):
+            if name == self.workspace_name:
+                controller = self
+            else:
+                controller = copy.copy(self)
+                controller._select_workspace(name)
+            logger.info(f"Syncing workspace {name}.")
+            controller.sync()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for future in [executor.submit(sync_workspace, name) for name in workspace_names]:
+                future.result()
 
     def load_project(self, project_name):
         current_project = self.current_project
-        if current_project is None or current_project == project_name:
-            self._assign_project(project_name)
-            self.pull()
-        else:
+        if current_project is not None and current_project != project_name:
             confirmation = input(f"\"{current_project}\" is assigned to current project. Overwrite? (y/n): ")
             if confirmation != "y":
                 return
-            self.current_project = None
-            self.load_project(project_name)
+        self._switch_project(project_name)
 
     def list_projects(self, pattern):
         logger.info(f"Listing projects with pattern {pattern}.")
@@ -265,6 +568,19 @@ class LibrarianController:
                 print(f"- {project}")
         display()
 
+    def serve(self, host, port):
+        # run the daemon for this library and workspace until interrupted.
+        # the controller's own syncs (`sync` without args) share the daemon's cached service.
+        self.service = LibraryService(self.library_path, self.workspace_path, self.sync_targets, cache=True, sync_filters=self.sync_filters)
+        service = AsyncLibraryService(self.service)
+        daemon = LibrarianDaemon(service, host=host, port=port, sync_function=self.sync_assigned)
+        try:
+            asyncio.run(daemon.serve_forever())
+        except KeyboardInterrupt:
+            print("Stopped Librarian daemon.")
+        finally:
+            service.close()
+
     def delete_projects(self, project_names, pattern, safe=True):
         # prioritize project names, then pattern.
         if (project_names is None or len(project_names) == 0) and pattern is None:
@@ -275,7 +591,22 @@ class LibrarianController:
             project_names = self.service.list_projects(pattern=pattern)
             return self.delete_projects(project_names, None)
 
-        self.service.delete_projects(project_names, safe=safe)
+        for name in project_names:
+            if not self.service.is_project(name):
+                raise InvalidProjectException(name)
+
+        if safe:
+            @spacing
+            def display():
+                for name in project_names:
+                    print(f"- {name}")
+            print("Delete the following projects?")
+            display()
+            confirmation = input(f"Confirm (y/n): ")
+            if confirmation != "y":
+                return
+
+        self.service.delete_projects(project_names)
         if self.current_project in project_names:
             self._unassign_project()
     
@@ -0,0 +1,213 @@
+import asyncio
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import secrets
+from typing import Awaitable, Callable, Dict
+
+from librarian.async_service import AsyncLibraryService, ProgressCallback
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 47311
+
+"""
+Daemon protocol: newline-delimited JSON over a local TCP connection.
+
+* Once listening, the daemon writes a random token to a file readable only by the user (see `default_token_path`).
+* The client sends a request with that token: {"token": "...", "command": "push", "args": {"to_project_name": "hello-world"}}.
+  A line that isn't a JSON request or carries a wrong token closes the connection.
+* The daemon answers with any number of progress events, {"event": "progress", "count": 3, "path": "..."},
+  followed by exactly one {"event": "result", "result": ...} or {"event": "error", "message": "..."}.
+* A connection runs one request at a time. Sending any line while a request runs
+  (e.g. {"command": "cancel"}) or closing the connection cancels it.
+
+Commands are the `AsyncLibraryService` methods listed in `COMMANDS`, plus "refresh" to drop the caches.
+"sync" without args syncs the workspace's assigned project with its stored sync state (like `librarian sync`).
+With explicit "project_name", "previous_state" and "last_sync_time" the client owns the sync state instead.
+"""
+
+COMMANDS = {
+    'list': lambda service, args, progress: service.list_projects(**args),
+    'create': lambda service, args, progress: service.create_project(**args, progress=progress),
+    'copy': lambda service, args, progress: service.copy_project(**args, progress=progress),
+    'pull': lambda service, args, progress: service.pull_project(**args, progress=progress),
+    'push': lambda service, args, progress: service.push_project(**args, progress=progress),
+    'sync': lambda service, args, progress: service.sync(**args, progress=progress),
+    'verify': lambda service, args, progress: service.verify(**args),
+    'prepare': lambda service, args, progress: service.stage_project(**args, progress=progress),
+    'delete': lambda service, args, progress: service.delete_projects(**args),
+}
+
+def is_loopback(host:str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def default_token_path(port:int) -> str:
+    # one token file per port, so daemons on different ports don't replace each other's tokens.
+    return os.path.join(os.path.expanduser("~"), f".librarian-daemon-{port}.token")
+
+def write_token(token_path:str) -> str:
+    # write a new token to a file only the current user can read.
+    token = secrets.token_hex(32)
+    temp_path = f"{token_path}.{os.getpid()}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    fd = os.open(temp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+    with os.fdopen(fd, "w") as writer:
+        writer.write(token)
+    os.replace(temp_path, token_path)
+    return token
+
+def read_token(token_path:str) -> str:
+    with open(token_path, "r") as reader:
+        return reader.read().strip()
+
+def remove_token(token_path:str, token:str):
+    # remove the token file unless another daemon has written its own token since.
+    try:
+        if read_token(token_path) == token:
+            os.remove(token_path)
+    except FileNotFoundError:
+        pass
+
+class LibrarianDaemon:
+    """Serves library operations from one long-running process, so the project
+    index and library scans stay cached in memory between commands."""
+
+    def __init__(self, service:AsyncLibraryService, host:str=DEFAULT_HOST, port:int=DEFAULT_PORT, token_path:str=None, sync_function:Callable=None):
+        if not is_loopback(host):
+            raise ValueError(f"Librarian daemon only listens on loopback addresses, not {host}.")
+        self.service = service
+        self.host = host
+        self.port = port
+        self.token_path = token_path if token_path is not None else default_token_path(port)
+        self.token = None
+        # blocking function syncing the assigned project with stored sync state (takes `on_file`).
+        self.sync_function = sync_function
+
+    async def serve_forever(self):
+        # bind before writing the token, so a daemon that can't start never replaces a running daemon's token.
+        server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        try:
+            self.token = write_token(self.token_path)
+            logger.info(f"Librarian daemon listening on {self.host}:{self.port}.")
+            async with server:
+                await server.serve_forever()
+        finally:
+            server.close()
+            if self.token is not None:
+                remove_token(self.token_path, self.token)
+
+    async def _handle_connection(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        async def send(message:Dict):
+            if writer.is_closing():
+                raise ConnectionResetError("Client disconnected.")
+            writer.write((json.dumps(message) + "\n").encode())
+            await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                try:
+                    request = json.loads(line)
+                except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                    await send({"event": "error", "message": f"Invalid request: {e}"})
+                    return
+                if not isinstance(request, dict) or not hmac.compare_digest(str(request.get("token")), self.token):
+                    logger.warning("Rejected request with invalid token.")
+                    await send({"event": "error", "message": "Invalid token."})
+                    return
+                await self._handle_request(request, reader, send)
+        except ConnectionError:
+            logger.info("Client disconnected.")
+        finally:
+            writer.close()
+
+    async def _handle_request(self, request:Dict, reader:asyncio.StreamReader, send:Callable[[Dict], Awaitable[None]]):
+        command = request.get("command")
+        args = request.get("args") or dict()
+        if command == "refresh":
+            self.service.clear_cache()
+            await send({"event": "result", "result": None})
+            return
+        if command not in COMMANDS:
+            await send({"event": "error", "message": f"Unknown command: {command}"})
+            return
+
+        latest_progress = None
+        progressed = asyncio.Event()
+
+        def progress(count, path):
+            nonlocal latest_progress
+            latest_progress = {"event": "progress", "count": count, "path": path}
+            progressed.set()
+
+        async def send_progress():
+            # only the latest progress is sent, so a slow client doesn't make the write buffer grow.
+            while True:
+                await progressed.wait()
+                progressed.clear()
+                await send(latest_progress)
+
+        logger.info(f"Running {command} {args}.")
+        if command == "sync" and not args and self.sync_function is not None:
+            coroutine = self.service.run(self.sync_function, progress=progress)
+        else:
+            coroutine = COMMANDS[command](self.service, args, progress)
+        task = asyncio.ensure_future(coroutine)
+        cancel_watch = asyncio.ensure_future(reader.readline())
+        progress_sender = asyncio.ensure_future(send_progress())
+        await asyncio.wait({task, cancel_watch, progress_sender}, return_when=asyncio.FIRST_COMPLETED)
+
+        if not task.done():
+            # client sent a line (cancel) or disconnected while the command was running.
+            logger.info(f"Cancelling {command}.")
+            task.cancel()
+        cancel_watch.cancel()
+        progress_sender.cancel()
+        # let the watchers finish before the connection reads the next request.
+        await asyncio.wait({cancel_watch, progress_sender})
+        for watcher in (cancel_watch, progress_sender):
+            if not watcher.cancelled() and watcher.exception() is not None:
+                logger.debug(f"Connection closed while running {command}: {watcher.exception()}")
+        try:
+            result = await task
+        except asyncio.CancelledError:
+            await send({"event": "error", "message": "Operation was cancelled."})
+        except Exception as e:
+            logger.warning(f"{command} failed: {e}")
+            await send({"event": "error", "message": str(e)})
+        else:
+            await send({"event": "result", "result": result})
+
+async def request(command:str, args:Dict=None, progress:ProgressCallback=None, host:str=DEFAULT_HOST, port:int=DEFAULT_PORT, token_path:str=None):
+    # send one request to a running daemon and return its result.
+    token = read_token(token_path if token_path is not None else default_token_path(port))
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write((json.dumps({"token": token, "command": command, "args": args or dict()}) + "\n").encode())
+        await writer.drain()
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise ConnectionError("Librarian daemon closed the connection.")
+            message = json.loads(line)
+            if message["event"] == "progress":
+                if progress is not None:
+                    progress(message["count"], message["path"])
+            elif message["event"] == "result":
+                return message["result"]
+            else:
+                raise RuntimeError(message["message"])
+    finally:
+        writer.close()
@@ -2,6 +2,22 @@ class InvalidProjectException(Exception):
     def __init__(self, project_name):
         super().__init__(f"\"{project_name}\" is invalid project or doesn't exist.")
 
+class InvalidWorkspaceException(Exception):
+    def __init__(self, workspace_name):
+        super().__init__(f"\"{workspace_name}\" is invalid workspace or doesn't exist.")
+
 class FolderCollisionException(Exception):
+    def __init__(self, message="The library and workspace cannot be assigned the same directory."):
+        super().__init__(message)
+
+class LockTimeoutException(Exception):
+    def __init__(self, lock_path):
+        super().__init__(f"Timed out waiting for lock \"{lock_path}\". If it is held from another machine and no librarian process is running there, delete the lock file.")
+
+class OperationCancelledException(Exception):
     def __init__(self):
-        super().__init__("The library and workspace cannot be assigned the same directory.")
\ No newline at end of file
+        super().__init__("Operation was cancelled.")
+
+class InvalidPatternException(Exception):
+    def __init__(self, pattern, reason):
+        super().__init__(f"\"{pattern}\" is invalid filter pattern: {reason}.")
@@ -0,0 +1,185 @@
+import ctypes
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from librarian.exceptions import LockTimeoutException, OperationCancelledException
+
+LOCK_FILENAME = ".librarian.lock"
+# a lock file without owner is only considered stale after this many seconds (its owner may be writing it).
+EMPTY_LOCK_GRACE_PERIOD = 10
+
+logger = logging.getLogger(__name__)
+
+# locks held by this process: lock path -> (thread id, depth).
+_held_locks = dict()
+_held_locks_guard = threading.Lock()
+
+# cancel event of the operation running in this thread (see `cancel_lock_waits`).
+_cancellation = threading.local()
+
+@contextmanager
+def cancel_lock_waits(cancel_event:threading.Event):
+    # locks acquired in this thread stop waiting with OperationCancelledException once `cancel_event` is set.
+    previous_event = getattr(_cancellation, "event", None)
+    _cancellation.event = cancel_event
+    try:
+        yield
+    finally:
+        _cancellation.event = previous_event
+
+def _pid_alive(pid:int) -> bool:
+    if os.name == "nt":
+        # os.kill would terminate the process on Windows.
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        STILL_ACTIVE = 259
+        kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            # no such process, or no access to it (which means it exists).
+            return ctypes.get_last_error() == 5
+        try:
+            exit_code = ctypes.c_ulong()
+            kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+            return exit_code.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _owner() -> str:
+    return f"{socket.gethostname()} {os.getpid()}"
+
+class FileLock:
+    """Inter-process lock backed by an exclusively created lock file.
+
+    The lock is reentrant for the thread holding it, so nested service calls
+    (e.g. assign -> push -> pull) don't deadlock on their own locks. The file
+    records the owner's host and PID, and a lock whose owner on this host is no
+    longer running is broken.
+    """
+
+    def __init__(self, path:str, timeout:float=None, poll_interval:float=0.1):
+        self.path = os.path.abspath(path)
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+    def _reenter(self) -> bool:
+        with _held_locks_guard:
+            owner = _held_locks.get(self.path)
+            if owner is not None and owner[0] == threading.get_ident():
+                _held_locks[self.path] = (owner[0], owner[1] + 1)
+                return True
+            return False
+
+    def acquire(self, cancel_event:threading.Event=None):
+        if self._reenter():
+            return
+        if cancel_event is None:
+            cancel_event = getattr(_cancellation, "event", None)
+        start_time = time.time()
+        waiting = False
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if self._break_if_stale():
+                    continue
+                if self.timeout is not None and time.time() - start_time >= self.timeout:
+                    raise LockTimeoutException(self.path)
+                if cancel_event is not None and cancel_event.is_set():
+                    raise OperationCancelledException()
+                if not waiting:
+                    logger.info(f"Waiting for lock {self.path}.")
+                    waiting = True
+                if cancel_event is not None:
+                    cancel_event.wait(self.poll_interval)
+                else:
+                    time.sleep(self.poll_interval)
+                continue
+            with os.fdopen(fd, "w") as writer:
+                writer.write(_owner())
+            break
+        with _held_locks_guard:
+            _held_locks[self.path] = (threading.get_ident(), 1)
+        logger.debug(f"Acquired lock {self.path}.")
+
+    def _read_owner(self, path:str=None) -> str:
+        try:
+            with open(path or self.path, "r") as reader:
+                return reader.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _is_stale(self, owner:str, path:str=None) -> bool:
+        if owner == "":
+            try:
+                return time.time() - os.path.getmtime(path or self.path) > EMPTY_LOCK_GRACE_PERIOD
+            except FileNotFoundError:
+                return False
+        host, _, pid = owner.rpartition(" ")
+        if host not in ("", socket.gethostname()) or not pid.isdigit():
+            # can't check processes on other hosts (lock files of older versions only hold a PID).
+            return False
+        return not _pid_alive(int(pid))
+
+    def _break_if_stale(self) -> bool:
+        owner = self._read_owner()
+        if owner is None or not self._is_stale(owner):
+            return False
+        # only one process breaks the lock at a time, and it checks the owner again while holding the guard.
+        # (the lock file can't change meanwhile: its owner is gone and breaking needs the guard.)
+        guard_path = self.path + ".break"
+        try:
+            fd = os.open(guard_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            guard_owner = self._read_owner(guard_path)
+            if guard_owner is not None and self._is_stale(guard_owner, guard_path):
+                # a process died while breaking the lock.
+                try:
+                    os.remove(guard_path)
+                except FileNotFoundError:
+                    pass
+            return False
+        try:
+            with os.fdopen(fd, "w") as writer:
+                writer.write(_owner())
+            owner = self._read_owner()
+            if owner is None:
+                return True
+            if not self._is_stale(owner):
+                return False
+            os.remove(self.path)
+        finally:
+            os.remove(guard_path)
+        logger.warning(f"Broke stale lock {self.path} held by {owner or 'unknown process'}.")
+        return True
+
+    def release(self):
+        with _held_locks_guard:
+            thread_id, depth = _held_locks[self.path]
+            if depth > 1:
+                _held_locks[self.path] = (thread_id, depth - 1)
+                return
+            del _held_locks[self.path]
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            # directory holding the lock was removed (e.g. deleted project).
+            pass
+        logger.debug(f"Released lock {self.path}.")
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -1,24 +1,63 @@
 import logging
-from typing import List, Optional, Dict
+from typing import Callable, List, Optional, Dict, Tuple
 import os
 import re
 import shutil
 import fnmatch
+import time
+from contextlib import nullcontext
 
 from librarian.exceptions import InvalidProjectException
+from librarian.lock import FileLock, LOCK_FILENAME
 from librarian.syncer.data import Bucket
 from librarian.syncer import sync_buckets
+from librarian.syncer.filters import PathFilter, move_excluded, remove_unexcluded
+from librarian.syncer.stage import mirror_files, stage_files
+from librarian.syncer.verify import verify_files
 
 logger = logging.getLogger(__name__)
 
 STUDIO_PROJECT_FILENAME = ".studio_project"
+LIBRARY_INDEX_FILENAME = ".librarian-index"
+TEMP_SUFFIX = ".librarian-tmp"
+STAGING_DIRNAME = ".librarian-staging"
+STAGED_PROJECT_FILENAME = ".staged_project"
+STAGING_PROJECT_FILENAME = ".staging_project"
+
+def remove_path(path):
+    if os.path.isfile(path):
+        os.remove(path)
+    elif os.path.isdir(path):
+        shutil.rmtree(path)
 
 class LibraryService:
+    """Library operations between a library and a workspace.
 
-    def __init__(self, library_path:str, workspace_path:str, file_names:List[str]):
+    The service never prompts; confirmations are up to the caller. Methods that
+    copy files accept an `on_file` callback that is called with each file path
+    before it is copied and may raise to abort the operation.
+
+    With `cache` enabled the project index and library scans are kept in memory
+    between calls (see `librarian.daemon`). Library scans are revalidated against
+    the project's `.studio_project` mtime, which every write to a project touches.
+    The project index is revalidated against `.librarian-index` in the library,
+    which is rewritten whenever a project is created or deleted.
+
+    `sync_filters` maps sync targets to gitignore-style patterns
+    (`{"UserData": {"exclude": ["cap/"], "include": []}}`, see `librarian.syncer.filters`).
+    """
+
+    def __init__(self, library_path:str, workspace_path:str, file_names:List[str], cache:bool=False, sync_filters:Dict[str, Dict[str, List[str]]]=None):
         self.library_path = library_path
         self.workspace_path = workspace_path
         self.file_names = file_names
+        self.cache = cache
+        self.filters = {
+            file: PathFilter(include=patterns.get('include'), exclude=patterns.get('exclude'))
+            for file, patterns in (sync_filters or dict()).items()
+        }
+        self._project_index = None
+        self._scan_cache = dict()
 
     def get_sync_state(self, project_path) -> Dict:
         sync_state = dict()
@@ -29,40 +68,110 @@ class LibraryService:
             if os.path.isfile(file_path):
                 sync_state[file_path] = os.path.getmtime(file_path)
             if os.path.isdir(file_path):
-                sync_state[file_path] = Bucket(file_path).files
+                sync_state[file_path] = Bucket(file_path, path_filter=self.filters.get(file)).files
         return sync_state
 
     def to_project_path(self, project_name:str) -> str:
         return os.path.join(self.library_path, project_name)
 
+    def project_lock(self, project_name:str) -> FileLock:
+        # lock guarding a project's files against concurrent librarian processes.
+        return FileLock(os.path.join(self.to_project_path(project_name), LOCK_FILENAME))
+
+    def workspace_lock(self) -> FileLock:
+        # lock guarding the workspace files against concurrent librarian processes.
+        return FileLock(os.path.join(self.workspace_path, LOCK_FILENAME))
+
+    def staging_path(self) -> str:
+        return os.path.join(self.workspace_path, STAGING_DIRNAME)
+
+    def staging_lock(self) -> FileLock:
+        return FileLock(self.staging_path() + ".lock")
+
     def is_project(self, project_name:str) -> bool:
         # check if project name corresponds to a valid project in the library.
         return project_name is not None and os.path.exists(os.path.join(self.library_path, project_name, STUDIO_PROJECT_FILENAME))
     
-    def copy_files(self, source, destination):
+    def _touch_project(self, project_name:str):
+        # mark project as modified (invalidates cached scans of the project).
+        os.utime(os.path.join(self.to_project_path(project_name), STUDIO_PROJECT_FILENAME))
+
+    def _library_bucket(self, project_name:str, file:str) -> Bucket:
+        path = os.path.join(self.to_project_path(project_name), file)
+        if not self.cache:
+            return Bucket(path, path_filter=self.filters.get(file))
+        marker = os.path.getmtime(os.path.join(self.to_project_path(project_name), STUDIO_PROJECT_FILENAME))
+        cached = self._scan_cache.get(path)
+        if cached is not None and cached[0] == marker:
+            return cached[1]
+        bucket = Bucket(path, path_filter=self.filters.get(file))
+        self._scan_cache[path] = (marker, bucket)
+        return bucket
+
+    def _keep_excluded(self, file:str, old_path:str, new_path:str):
+        # move excluded paths of files that are being replaced into their replacement.
+        path_filter = self.filters.get(file)
+        if path_filter is None or not os.path.isdir(old_path) or os.path.isfile(new_path):
+            return
+        created = not os.path.exists(new_path)
+        os.makedirs(new_path, exist_ok=True)
+        move_excluded(old_path, new_path, path_filter)
+        if created and not os.listdir(new_path):
+            os.rmdir(new_path)
+
+    def _index_marker(self) -> Optional[str]:
+        marker_path = os.path.join(self.library_path, LIBRARY_INDEX_FILENAME)
+        if not os.path.exists(marker_path):
+            return None
+        with open(marker_path, "r") as reader:
+            return reader.read()
+
+    def _touch_index(self):
+        # mark the project index as changed (invalidates cached indices in every process).
+        self._project_index = None
+        with open(os.path.join(self.library_path, LIBRARY_INDEX_FILENAME), "w") as writer:
+            writer.write(f"{time.time_ns()}-{os.getpid()}")
+
+    def clear_cache(self):
+        self._project_index = None
+        self._scan_cache.clear()
+
+    def copy_files(self, source, destination, on_file:Callable[[str], None]=None):
         # copy contents from files. (replace destination if exist)
+        def copy_function(src, dst):
+            if on_file is not None:
+                on_file(src)
+            return shutil.copy2(src, dst)
+
         for file in self.file_names:
             source_file_path = os.path.join(source, file)
             destination_file_path = os.path.join(destination, file)
 
-            # clear existing files
-            if os.path.exists(destination_file_path):
-                if os.path.isfile(destination_file_path):
-                    os.remove(destination_file_path)
-                if os.path.isdir(destination_file_path):
-                    shutil.rmtree(destination_file_path)
-
-            if not os.path.exists(source_file_path):
-                continue
-
-            if os.path.isfile(source_file_path):
-                shutil.copy(source_file_path, destination_file_path)
-            if os.path.isdir(source_file_path):
-                shutil.copytree(source_file_path, destination_file_path)
+            # copy next to the destination first, so an aborted copy leaves the destination intact.
+            temp_file_path = destination_file_path + TEMP_SUFFIX
+            remove_path(temp_file_path)
+            try:
+                if os.path.isfile(source_file_path):
+                    if on_file is not None:
+                        on_file(source_file_path)
+                    shutil.copy(source_file_path, temp_file_path)
+                if os.path.isdir(source_file_path):
+                    path_filter = self.filters.get(file)
+                    ignore = path_filter.ignore_function(source_file_path) if path_filter is not None else None
+                    shutil.copytree(source_file_path, temp_file_path, copy_function=copy_function, ignore=ignore)
+            except BaseException:
+                remove_path(temp_file_path)
+                raise
+
+            # replace existing files
+            self._keep_excluded(file, destination_file_path, temp_file_path)
+            remove_path(destination_file_path)
+            if os.path.exists(temp_file_path):
+                os.rename(temp_file_path, destination_file_path)
 
     # CRUD operations.
     # create
-    def create_project(self, project_name:str, source_project_path=None):
+    def create_project(self, project_name:str, source_project_path=None, on_file:Callable[[str], None]=None):
         if source_project_path is None:
             source_project_path = self.workspace_path
 
@@ -87,14 +196,19 @@ class LibraryService:
             raise FileExistsError(f"Project {project_name} exists.")
 
         os.makedirs(project_path, exist_ok=True)
-        # add metadata
-        with open(metadata_path, "w") as writer:
-            writer.write("")
-
-        # copy contents from files.
-        self.copy_files(source_project_path, project_path)
-
-    def copy_project(self, source_project_name, destination_project_name:str=None) -> Optional[str]:
+        # don't snapshot a workspace that is being pulled into.
+        workspace_lock = self.workspace_lock() if source_project_path == self.workspace_path else nullcontext()
+        with workspace_lock, self.project_lock(project_name):
+            # add metadata
+            with open(metadata_path, "w") as writer:
+                writer.write("")
+            self._touch_index()
+
+            # copy contents from files.
+            self.copy_files(source_project_path, project_path, on_file=on_file)
+            self._touch_project(project_name)
+
+    def copy_project(self, source_project_name, destination_project_name:str=None, overwrite:bool=False, on_file:Callable[[str], None]=None) -> str:
         if source_project_name == destination_project_name:
             raise KeyError("Destination of copy cannot be source.")
 
@@ -109,20 +223,32 @@ class LibraryService:
         source_project_path = self.to_project_path(source_project_name)
 
         if self.is_project(destination_project_name):
-            confirmation = input("A project already exists with this name. Override? (y/n): ")
-            if confirmation != "y":
-                return None
+            if not overwrite:
+                raise FileExistsError(f"Project {destination_project_name} exists.")
             destination_project_path = self.to_project_path(destination_project_name)
-            self.copy_files(source_project_path, destination_project_path)
+            # lock in a fixed order, so copies in opposite directions don't deadlock.
+            first_lock, second_lock = sorted((self.project_lock(source_project_name), self.project_lock(destination_project_name)), key=lambda lock: lock.path)
+            with first_lock, second_lock:
+                self.copy_files(source_project_path, destination_project_path, on_file=on_file)
+                self._touch_project(destination_project_name)
             return destination_project_name
         else:
-            self.create_project(destination_project_name, source_project_path=source_project_path)
+            with self.project_lock(source_project_name):
+                self.create_project(destination_project_name, source_project_path=source_project_path, on_file=on_file)
             return destination_project_name
 
     # get
     def list_projects(self, pattern=None) -> List[str]:
         # list projects in library (that fit optional pattern argument).
         library_path = self.library_path
+        if self.cache:
+            marker = self._index_marker()
+            if self._project_index is None or self._project_index[0] != marker:
+                self._project_index = (marker, self._walk_projects(library_path, None))
+            return [project for project in self._project_index[1] if pattern is None or fnmatch.fnmatch(project, pattern)]
+        return self._walk_projects(library_path, pattern)
+
+    def _walk_projects(self, library_path, pattern) -> List[str]:
         projects = list()
         for dirpath, dirnames, filenames in os.walk(library_path):
             if STUDIO_PROJECT_FILENAME in filenames:
@@ -131,34 +257,107 @@ class LibraryService:
                     projects.append(os.path.relpath(dirpath, self.library_path))
         return projects
 
+    def staged_project(self) -> Optional[str]:
+        # project whose files are staged in the workspace (only set once staging is complete).
+        marker_path = os.path.join(self.staging_path(), STAGED_PROJECT_FILENAME)
+        if not os.path.exists(marker_path):
+            return None
+        with open(marker_path, "r") as reader:
+            return reader.read()
+
+    def _staging_project(self) -> Optional[str]:
+        # project that is being staged (or whose staging was interrupted).
+        marker_path = os.path.join(self.staging_path(), STAGING_PROJECT_FILENAME)
+        try:
+            with open(marker_path, "r") as reader:
+                return reader.read()
+        except FileNotFoundError:
+            return None
+
     # update
-    def pull_project(self, from_project_name):
+    def stage_project(self, project_name, on_file:Callable[[str], None]=None):
+        # stage project files next to the workspace, so pulling it later only applies a small delta.
+        logger.info(f"Staging project {project_name}.")
+        if not self.is_project(project_name):
+            raise InvalidProjectException(project_name)
+        project_path = self.to_project_path(project_name)
+        staging_path = self.staging_path()
+        with self.staging_lock():
+            remove_path(staging_path)
+            os.makedirs(staging_path)
+            with open(os.path.join(staging_path, STAGING_PROJECT_FILENAME), "w") as writer:
+                writer.write(project_name)
+            for file in self.file_names:
+                source_file_path = os.path.join(project_path, file)
+                if not os.path.exists(source_file_path):
+                    continue
+                stage_files(source_file_path, os.path.join(self.workspace_path, file), os.path.join(staging_path, file), on_file=on_file, path_filter=self.filters.get(file))
+            with open(os.path.join(staging_path, STAGED_PROJECT_FILENAME), "w") as writer:
+                writer.write(project_name)
+
+    def _apply_stage(self, project_name, on_file:Callable[[str], None]=None):
+        # bring staged files up to date with the library, then swap them into the workspace.
+        project_path = self.to_project_path(project_name)
+        staging_path = self.staging_path()
+        for file in self.file_names:
+            staged_file_path = os.path.join(staging_path, file)
+            mirror_files(os.path.join(project_path, file), staged_file_path, on_file=on_file, path_filter=self.filters.get(file))
+
+        for file in self.file_names:
+            staged_file_path = os.path.join(staging_path, file)
+            workspace_file_path = os.path.join(self.workspace_path, file)
+            temp_file_path = workspace_file_path + TEMP_SUFFIX
+            remove_path(temp_file_path)
+            self._keep_excluded(file, workspace_file_path, staged_file_path)
+            if os.path.exists(workspace_file_path):
+                os.rename(workspace_file_path, temp_file_path)
+            if os.path.exists(staged_file_path):
+                os.rename(staged_file_path, workspace_file_path)
+            remove_path(temp_file_path)
+        remove_path(staging_path)
+
+    def pull_project(self, from_project_name, on_file:Callable[[str], None]=None):
         # pull changes from library to workspace (aka. load project).
         logger.info(f"Pulling from project {from_project_name}.")
         if not self.is_project(from_project_name):
             raise InvalidProjectException(from_project_name)
         project_path = self.to_project_path(from_project_name)
-        self.copy_files(project_path, self.workspace_path)
-
-    def push_project(self, to_project_name):
+        with self.workspace_lock(), self.project_lock(from_project_name):
+            # only wait for a background stage of this project, a stage of another project is left alone.
+            if from_project_name in (self.staged_project(), self._staging_project()):
+                with self.staging_lock():
+                    if self.staged_project() == from_project_name:
+                        logger.info(f"Applying staged files of {from_project_name}.")
+                        self._apply_stage(from_project_name, on_file=on_file)
+                        return
+            self.copy_files(project_path, self.workspace_path, on_file=on_file)
+
+    def push_project(self, to_project_name, on_file:Callable[[str], None]=None):
         # push changes from workspace to library.
         logger.info(f"Pushing project {to_project_name}.")
         if not self.is_project(to_project_name):
             raise InvalidProjectException(to_project_name)
         project_path = self.to_project_path(to_project_name)
-        self.copy_files(self.workspace_path, project_path)
+        with self.workspace_lock(), self.project_lock(to_project_name):
+            self.copy_files(self.workspace_path, project_path, on_file=on_file)
+            self._touch_project(to_project_name)
 
     def get_sync_state(self):
         new_state = dict()
         for file in self.file_names:
             workspace_file_path = os.path.join(self.workspace_path, file)
             if os.path.isdir(workspace_file_path):
-                new_state[file] = Bucket(path=workspace_file_path).files
+                new_state[file] = Bucket(path=workspace_file_path, path_filter=self.filters.get(file)).files
         return new_state
 
-    def sync(self, project_name, previous_state:Dict=None, last_sync_time=None) -> Dict:
+    def sync(self, project_name, previous_state:Dict=None, last_sync_time=None, on_file:Callable[[str], None]=None) -> Dict:
         # sync between library and workspace and returns the final state as output.
+        with self.workspace_lock(), self.project_lock(project_name):
+            return self._sync(project_name, previous_state=previous_state, last_sync_time=last_sync_time, on_file=on_file)
+
+    def _sync(self, project_name, previous_state:Dict=None, last_sync_time=None, on_file:Callable[[str], None]=None) -> Dict:
         new_state = dict()
+        library_changed = False
         for file in self.file_names:
             workspace_file_path = os.path.join(self.workspace_path, file)
             library_file_path = os.path.join(self.library_path, project_name, file)
@@ -180,6 +379,9 @@ class LibraryService:
                     dest_path = workspace_file_path
 
                 mtime = os.path.getmtime(source_path)
+                library_changed = True
+                if on_file is not None:
+                    on_file(source_path)
 
                 # modification detected after last sync --> copy file instead of delete
                 if mtime > last_sync_time:
@@ -189,14 +391,20 @@ class LibraryService:
                     if os.path.isfile(source_path):
                         shutil.copy2(source_path, dest_path)
                     elif os.path.isdir(source_path):
-                        shutil.copytree(source_path, dest_path)
+                        path_filter = self.filters.get(file)
+                        ignore = path_filter.ignore_function(source_path) if path_filter is not None else None
+                        shutil.copytree(source_path, dest_path, ignore=ignore)
                 
                 # no updates since last sync --> delete both files
                 else:
                     if os.path.isfile(source_path):
                         os.remove(source_path)
                     elif os.path.isdir(source_path):
-                        shutil.rmtree(source_path)
+                        remove_unexcluded(source_path, self.filters.get(file))
+                        if os.path.exists(source_path):
+                            # only excluded paths are left, keep it looking unchanged so it isn't copied back.
+                            os.utime(source_path, (mtime, mtime))
+                            continue
 
             # file exist in both workspace and library.
             if os.path.isfile(workspace_file_path):
@@ -206,49 +414,53 @@ class LibraryService:
                 if max(w_time, l_time) <= last_sync_time:
                     pass
                 elif w_time > l_time:
+                    if on_file is not None:
+                        on_file(workspace_file_path)
                     shutil.copy2(workspace_file_path, library_file_path)
+                    library_changed = True
                 elif l_time > w_time:
+                    if on_file is not None:
+                        on_file(library_file_path)
                     shutil.copy2(library_file_path, workspace_file_path)
                 
                 new_state[file] = os.path.getmtime(workspace_file_path)
 
             if os.path.isdir(workspace_file_path):
-                workspace_file_bucket = Bucket(workspace_file_path)
-                library_file_bucket = Bucket(library_file_path)
+                workspace_file_bucket = Bucket(workspace_file_path, path_filter=self.filters.get(file))
+                library_file_bucket = self._library_bucket(project_name, file)
                 previous_file_state = Bucket(files=previous_state.get(file)) if previous_state is not None and file in previous_state else None
-                sync_buckets(workspace_file_bucket, library_file_bucket, previous_state=previous_file_state, last_sync_time=last_sync_time)
-                new_state[file] = Bucket(path=workspace_file_path).files
+                changes = sync_buckets(workspace_file_bucket, library_file_bucket, previous_state=previous_file_state, last_sync_time=last_sync_time, on_file=on_file)
+                library_changed = library_changed or changes > 0
+                new_state[file] = Bucket(path=workspace_file_path, path_filter=self.filters.get(file)).files
+
+        if library_changed:
+            self._touch_project(project_name)
         return new_state
 
+    def verify(self, project_name, max_workers:int=None) -> List[Tuple[str, str]]:
+        # compare workspace and library files, and return (path, reason) for every mismatch.
+        logger.info(f"Verifying project {project_name}.")
+        if not self.is_project(project_name):
+            raise InvalidProjectException(project_name)
+        with self.workspace_lock(), self.project_lock(project_name):
+            return verify_files(self.workspace_path, self.to_project_path(project_name), self.file_names, max_workers=max_workers, filters=self.filters)
+
     # delete
-    def delete_project(self, project_name, safe=True) -> bool:
+    def delete_project(self, project_name):
         # delete project from library.
         logger.info(f"Deleting project {project_name}.")
         if not self.is_project(project_name):
             raise InvalidProjectException(project_name)
-        if safe:
-            confirmation = input(f"Delete project {project_name}? (y/n): ")
-            if confirmation != "y":
-                return False
-        shutil.rmtree(os.path.join(self.library_path, project_name))
-        return True
+        with self.project_lock(project_name):
+            shutil.rmtree(os.path.join(self.library_path, project_name))
+        self._touch_index()
 
     # delete multiple projects
-    def delete_projects(self, project_names, safe=True) -> bool:
+    def delete_projects(self, project_names):
         # check if all the projects are valid.
         for name in project_names:
             if not self.is_project(name):
                 raise InvalidProjectException(name)
-        
-        if safe:
-            print("Delete the following projects?\n-----")
-            for name in project_names:
-                print(f"- {name}")
-            print("-----")
-            confirmation = input(f"Confirm (y/n): ")
-            if confirmation!= "y":
-                return False
-        
+
         for name in project_names:
-            self.delete_project(name, safe=False)
-        return True
+            self.delete_project(name)
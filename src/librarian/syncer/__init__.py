@@ -1,4 +1,5 @@
 import os
+from typing import Callable
 from librarian.syncer.data import Bucket
 import shutil
 import logging
@@ -30,8 +31,9 @@ File sync expected behavior:
 * The algorithm treats the `UserData` folders like "buckets", i.e. it doesn't recognize folder structures and will not delete folders.
 """
 
-def sync_buckets(bucket_a:Bucket, bucket_b:Bucket, previous_state:Bucket=None, last_sync_time:int=None):
-    # sync buckets A and B so they are equal in bucket objects.
+def sync_buckets(bucket_a:Bucket, bucket_b:Bucket, previous_state:Bucket=None, last_sync_time:int=None, on_file:Callable[[str], None]=None) -> int:
+    # sync buckets A and B so they are equal in bucket objects, and return the number of changes.
+    # `on_file` is called with the path of every changed file before it is handled and may raise to abort.
     
     if previous_state is None:
         previous_state = bucket_a
@@ -69,9 +71,13 @@ def sync_buckets(bucket_a:Bucket, bucket_b:Bucket, previous_state:Bucket=None, l
     for path in undeleted_paths:
         if max(bucket_a.files[path], bucket_b.files[path]) <= last_sync_time:
             continue
+        if on_file is not None:
+            on_file(path)
         copy_most_recent(bucket_a, bucket_b, path)
 
     for path in deleted_in_one_bucket:
+        if on_file is not None:
+            on_file(path)
         # check if undeleted one is modified.
         if path in paths_a:
             if bucket_a.files[path] > last_sync_time:
@@ -87,10 +93,16 @@ def sync_buckets(bucket_a:Bucket, bucket_b:Bucket, previous_state:Bucket=None, l
                 os.remove(os.path.join(bucket_b.path, path))
     
     for path in added_in_two_buckets:
+        if on_file is not None:
+            on_file(path)
         copy_most_recent(bucket_a, bucket_b, path)
 
     for path in added_in_one_bucket:
+        if on_file is not None:
+            on_file(path)
         if path in paths_a:
             copy_one_way(bucket_a, bucket_b, path)
         else:
-            copy_one_way(bucket_b, bucket_a, path)
\ No newline at end of file
+            copy_one_way(bucket_b, bucket_a, path)
+
+    return total_changes
\ No newline at end of file
@@ -1,7 +1,8 @@
 import os
+from librarian.syncer.filters import PathFilter, walk
 
 class Bucket:
-    def __init__(self, path=None, files=None): # path must exist.
+    def __init__(self, path=None, files=None, path_filter:PathFilter=None): # path must exist.
 
         # generate from path.
         if path is not None and not os.path.exists(path):
@@ -9,7 +10,7 @@ class Bucket:
         elif path is not None:
             self.path = path
             self.files = dict()
-            for root, _, filename in os.walk(path):
+            for root, _, filename in walk(path, path_filter):
                 for file in filename:
                     relative_path = os.path.join(root, file)[len(path) + 1:]
                     mtime = self.get_mtime(relative_path)
@@ -0,0 +1,183 @@
+import os
+import re
+import shutil
+from typing import Callable, List, Optional, Set
+from librarian.exceptions import InvalidPatternException
+
+"""
+Filter expected behavior:
+* Patterns use gitignore syntax and match paths relative to the sync target (e.g. `cap/` or `/cache/*.dat` for `UserData`).
+* Exclude patterns are applied in order and the last match wins, so `!pattern` re-includes a path.
+* If include patterns are given, only files matching one of them (themselves or through a parent directory) are kept.
+* An excluded directory is never walked, so nothing below it can be re-included (as in gitignore).
+* Excluded paths are left alone in the destination: they are neither copied, deleted nor synced.
+"""
+
+def _translate(pattern:str) -> str:
+    # translate a gitignore glob (without negation, anchoring or trailing slash) to a regex.
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+            continue
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                regex += re.escape(c)
+            else:
+                group = pattern[i + 1:end]
+                negated = group.startswith("!")
+                if negated:
+                    group = group[1:]
+                if group == "":
+                    raise re.error("empty character class")
+                # escape everything except ranges, and check that ranges are ordered.
+                members = ""
+                j = 0
+                while j < len(group):
+                    if j + 2 < len(group) and group[j + 1] == "-":
+                        if group[j] > group[j + 2]:
+                            raise re.error(f"bad character range {group[j:j + 3]}")
+                        members += re.escape(group[j]) + "-" + re.escape(group[j + 2])
+                        j += 3
+                    else:
+                        members += re.escape(group[j])
+                        j += 1
+                regex += f"[{'^' if negated else ''}{members}]"
+                i = end
+        elif c == "\\" and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(c)
+        i += 1
+    return regex
+
+class _Pattern:
+    def __init__(self, line:str):
+        original = line
+        self.negated = line.startswith("!")
+        if self.negated:
+            line = line[1:]
+        self.directory_only = line.endswith("/")
+        line = line.rstrip("/")
+        anchored = "/" in line
+        line = line.lstrip("/")
+        prefix = "^" if anchored else "^(?:.*/)?"
+        try:
+            self.regex = re.compile(prefix + _translate(line) + "$")
+        except re.error as e:
+            raise InvalidPatternException(original, e)
+
+    def matches(self, rel_path:str, is_dir:bool) -> bool:
+        if self.directory_only and not is_dir:
+            return False
+        return self.regex.match(rel_path) is not None
+
+def _parse(lines:Optional[List[str]]) -> List[_Pattern]:
+    patterns = list()
+    for line in lines or []:
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+        patterns.append(_Pattern(line))
+    return patterns
+
+class PathFilter:
+    def __init__(self, include:List[str]=None, exclude:List[str]=None):
+        self.include = _parse(include)
+        self.exclude = _parse(exclude)
+
+    def is_excluded(self, rel_path:str, is_dir:bool=False) -> bool:
+        # check a path relative to the sync target (callers don't walk into excluded directories).
+        rel_path = rel_path.replace(os.sep, "/")
+        excluded = False
+        for pattern in self.exclude:
+            if pattern.matches(rel_path, is_dir):
+                excluded = not pattern.negated
+        if excluded:
+            return True
+        if self.include and not is_dir:
+            return not self._is_included(rel_path)
+        return False
+
+    def _is_included(self, rel_path:str) -> bool:
+        # a file is included if it or one of its parent directories matches (the last match wins).
+        parts = rel_path.split("/")
+        included = False
+        for pattern in self.include:
+            for i in range(1, len(parts) + 1):
+                if pattern.matches("/".join(parts[:i]), i < len(parts)):
+                    included = not pattern.negated
+                    break
+        return included
+
+    def excluded_names(self, root:str, directory:str, dirnames:List[str], filenames:List[str]) -> Set[str]:
+        # names in `directory` (somewhere below `root`) that are excluded.
+        rel_directory = os.path.relpath(directory, root)
+        excluded = set()
+        for names, is_dir in ((dirnames, True), (filenames, False)):
+            for name in names:
+                rel_path = name if rel_directory == "." else os.path.join(rel_directory, name)
+                if self.is_excluded(rel_path, is_dir):
+                    excluded.add(name)
+        return excluded
+
+    def ignore_function(self, root:str) -> Callable[[str, List[str]], Set[str]]:
+        # `ignore` argument for shutil.copytree(root, ...).
+        def ignore(directory, names):
+            dirnames = [name for name in names if os.path.isdir(os.path.join(directory, name))]
+            filenames = [name for name in names if name not in dirnames]
+            return self.excluded_names(root, directory, dirnames, filenames)
+        return ignore
+
+    def walk(self, root:str):
+        # os.walk over root that skips excluded directories and files.
+        for directory, dirnames, filenames in os.walk(root):
+            excluded = self.excluded_names(root, directory, dirnames, filenames)
+            dirnames[:] = [name for name in dirnames if name not in excluded]
+            yield directory, dirnames, [name for name in filenames if name not in excluded]
+
+def walk(root:str, path_filter:PathFilter=None):
+    if path_filter is None:
+        return os.walk(root)
+    return path_filter.walk(root)
+
+def move_excluded(source:str, target:str, path_filter:PathFilter=None):
+    # move excluded paths from source into target (so replacing a directory keeps them).
+    if path_filter is None or not os.path.isdir(source):
+        return
+    for directory, dirnames, filenames in os.walk(source):
+        excluded = path_filter.excluded_names(source, directory, dirnames, filenames)
+        dirnames[:] = [name for name in dirnames if name not in excluded]
+        for name in excluded:
+            target_path = os.path.join(target, os.path.relpath(os.path.join(directory, name), source))
+            if os.path.lexists(target_path):
+                continue
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            os.rename(os.path.join(directory, name), target_path)
+
+def remove_unexcluded(path:str, path_filter:PathFilter=None):
+    # remove a directory except its excluded paths (and the directories holding them).
+    if path_filter is None:
+        shutil.rmtree(path)
+        return
+    directories = list()
+    for directory, _, filenames in path_filter.walk(path):
+        directories.append(directory)
+        for filename in filenames:
+            os.remove(os.path.join(directory, filename))
+    for directory in reversed(directories):
+        if not os.listdir(directory):
+            os.rmdir(directory)
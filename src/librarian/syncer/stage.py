@@ -0,0 +1,89 @@
+import os
+import shutil
+from typing import Callable
+from librarian.syncer.filters import PathFilter, walk
+
+"""
+Staging expected behavior:
+* A stage is a copy of a library project's files built next to the workspace ahead of time.
+* Files that are equal (same size and mtime) in the workspace are hard-linked instead of copied, so only the delta is transferred.
+* Before a stage is used it is mirrored against the library again, which re-copies files that changed since staging
+  (including workspace files modified in place through a hard link).
+"""
+
+def same_stat(path_a:str, path_b:str) -> bool:
+    try:
+        stat_a = os.stat(path_a)
+        stat_b = os.stat(path_b)
+    except FileNotFoundError:
+        return False
+    return stat_a.st_size == stat_b.st_size and stat_a.st_mtime == stat_b.st_mtime
+
+def _link_or_copy(source:str, basis:str, target:str, on_file:Callable[[str], None]=None):
+    if same_stat(source, basis):
+        try:
+            os.link(basis, target)
+            return
+        except OSError:
+            # e.g. different file systems or no hard link support.
+            pass
+    if on_file is not None:
+        on_file(source)
+    shutil.copy2(source, target)
+
+def stage_files(source:str, basis:str, target:str, on_file:Callable[[str], None]=None, path_filter:PathFilter=None):
+    # build `target` equal to `source`, reusing equal files from `basis`.
+    if os.path.isfile(source):
+        _link_or_copy(source, basis, target, on_file)
+        return
+    for root, _, filenames in walk(source, path_filter):
+        rel_root = os.path.relpath(root, source)
+        os.makedirs(os.path.join(target, rel_root), exist_ok=True)
+        for filename in filenames:
+            rel_path = os.path.join(rel_root, filename)
+            _link_or_copy(os.path.join(source, rel_path), os.path.join(basis, rel_path), os.path.join(target, rel_path), on_file)
+
+def _update_file(source:str, target:str, on_file:Callable[[str], None]=None):
+    if same_stat(source, target):
+        return
+    # unlink first so a hard-linked target never writes through to the workspace.
+    if os.path.lexists(target):
+        os.remove(target)
+    if on_file is not None:
+        on_file(source)
+    shutil.copy2(source, target)
+
+def mirror_files(source:str, target:str, on_file:Callable[[str], None]=None, path_filter:PathFilter=None):
+    # update `target` so it is equal to `source`, copying only files that differ.
+    if os.path.isfile(source):
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        _update_file(source, target, on_file)
+        return
+    if not os.path.isdir(source):
+        if os.path.isfile(target):
+            os.remove(target)
+        elif os.path.isdir(target):
+            shutil.rmtree(target)
+        return
+    if os.path.isfile(target):
+        os.remove(target)
+
+    # remove what no longer exists in source.
+    for root, dirnames, filenames in walk(target, path_filter):
+        source_root = os.path.join(source, os.path.relpath(root, target))
+        for dirname in list(dirnames):
+            if not os.path.isdir(os.path.join(source_root, dirname)):
+                shutil.rmtree(os.path.join(root, dirname))
+                dirnames.remove(dirname)
+        for filename in filenames:
+            if not os.path.isfile(os.path.join(source_root, filename)):
+                os.remove(os.path.join(root, filename))
+
+    # add and update the rest.
+    for root, _, filenames in walk(source, path_filter):
+        rel_root = os.path.relpath(root, source)
+        os.makedirs(os.path.join(target, rel_root), exist_ok=True)
+        for filename in filenames:
+            rel_path = os.path.join(rel_root, filename)
+            _update_file(os.path.join(source, rel_path), os.path.join(target, rel_path), on_file)
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+from librarian.syncer.filters import PathFilter
+
+logger = logging.getLogger(__name__)
+
+HASH_CACHE_FILENAME = ".librarian-hashes.json"
+CHUNK_SIZE = 1 << 20
+# files are hashed in segments of this size, so large files are spread over threads too.
+SEGMENT_SIZE = 64 << 20
+
+"""
+Verification expected behavior:
+* Files are compared by relative path, then by size, and only files of equal size are hashed.
+* Hashes are persisted per root (workspace or project) together with the size and mtime they were computed for,
+  so unchanged files are never read again.
+* Hashing runs in a thread pool: hashlib releases the GIL while hashing, so threads use all cores.
+* Files are split into segments (SEGMENT_SIZE) that are hashed in parallel. A file's hash is the hash of its segment
+  hashes (or the segment hash for files with one segment), and the segment size is cached with it.
+"""
+
+def segments(size:int) -> List[Tuple[int, int]]:
+    # (offset, length) of each segment of a file of `size` bytes.
+    return [(offset, min(SEGMENT_SIZE, size - offset)) for offset in range(0, size, SEGMENT_SIZE)] or [(0, 0)]
+
+def hash_segment(path:str, offset:int, length:int) -> bytes:
+    digest = hashlib.blake2b()
+    with open(path, "rb") as reader:
+        reader.seek(offset)
+        remaining = length
+        while remaining > 0:
+            chunk = reader.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest.digest()
+
+def combine_segments(segment_digests:List[bytes]) -> str:
+    if len(segment_digests) == 1:
+        return segment_digests[0].hex()
+    digest = hashlib.blake2b()
+    for segment_digest in segment_digests:
+        digest.update(segment_digest)
+    return digest.hexdigest()
+
+def hash_file(path:str) -> str:
+    return combine_segments([hash_segment(path, offset, length) for offset, length in segments(os.path.getsize(path))])
+
+def _scan(path:str, file:str, target_rel_path:str, path_filter:PathFilter=None) -> Iterator[Tuple[str, os.stat_result]]:
+    with os.scandir(path) as entries:
+        for entry in entries:
+            entry_target_rel_path = entry.name if target_rel_path == "" else os.path.join(target_rel_path, entry.name)
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if path_filter is not None and path_filter.is_excluded(entry_target_rel_path, is_dir):
+                continue
+            if is_dir:
+                yield from _scan(entry.path, file, entry_target_rel_path, path_filter)
+            elif entry.is_file():
+                yield os.path.join(file, entry_target_rel_path), entry.stat()
+
+def scan_files(root:str, file_names:List[str], filters:Dict[str, PathFilter]=None) -> Dict[str, os.stat_result]:
+    # stat every file of the sync targets under root, keyed by path relative to root.
+    files = dict()
+    for file in file_names:
+        path = os.path.join(root, file)
+        if os.path.isfile(path):
+            files[file] = os.stat(path)
+        elif os.path.isdir(path):
+            files.update(_scan(path, file, "", (filters or dict()).get(file)))
+    return files
+
+class HashCache:
+    def __init__(self, root:str):
+        self.path = os.path.join(root, HASH_CACHE_FILENAME)
+        self.entries = dict()
+        self.used = dict()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as reader:
+                    self.entries = json.load(reader)
+            except (OSError, ValueError):
+                logger.warning(f"Ignoring unreadable hash cache {self.path}.")
+
+    def get(self, rel_path:str, stat:os.stat_result) -> Optional[str]:
+        entry = self.entries.get(rel_path)
+        if entry is None or entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns or entry[3:4] != [SEGMENT_SIZE]:
+            return None
+        self.used[rel_path] = entry
+        return entry[2]
+
+    def set(self, rel_path:str, stat:os.stat_result, digest:str):
+        self.used[rel_path] = [stat.st_size, stat.st_mtime_ns, digest, SEGMENT_SIZE]
+
+    def save(self):
+        # keep only entries of files seen in this run.
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as writer:
+            json.dump(self.used, writer)
+        os.replace(temp_path, self.path)
+
+def verify_files(root_a:str, root_b:str, file_names:List[str], max_workers:int=None, filters:Dict[str, PathFilter]=None) -> List[Tuple[str, str]]:
+    # compare sync targets between two roots and return (path, reason) for every mismatch.
+    files_a = scan_files(root_a, file_names, filters)
+    files_b = scan_files(root_b, file_names, filters)
+    logger.info(f"Verifying {len(files_a.keys() | files_b.keys())} files.")
+
+    mismatches = list()
+    for path in files_a.keys() - files_b.keys():
+        mismatches.append((path, f"missing in {root_b}"))
+    for path in files_b.keys() - files_a.keys():
+        mismatches.append((path, f"missing in {root_a}"))
+
+    candidates = list()
+    for path in files_a.keys() & files_b.keys():
+        if files_a[path].st_size != files_b[path].st_size:
+            mismatches.append((path, "size differs"))
+        else:
+            candidates.append(path)
+
+    cache_a = HashCache(root_a)
+    cache_b = HashCache(root_b)
+    digests = dict()
+    jobs = list()
+    for side, (root, files, cache) in enumerate(((root_a, files_a, cache_a), (root_b, files_b, cache_b))):
+        for path in candidates:
+            digest = cache.get(path, files[path])
+            if digest is None:
+                jobs.append((side, root, files, cache, path))
+            else:
+                digests[(side, path)] = digest
+
+    logger.info(f"Hashing {len(jobs)} files ({len(candidates) * 2 - len(jobs)} cached).")
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        futures = list()
+        for job in jobs:
+            side, root, files, cache, path = job
+            file_path = os.path.join(root, path)
+            futures.append((job, [executor.submit(hash_segment, file_path, offset, length) for offset, length in segments(files[path].st_size)]))
+        for (side, root, files, cache, path), segment_futures in futures:
+            digest = combine_segments([future.result() for future in segment_futures])
+            cache.set(path, files[path], digest)
+            digests[(side, path)] = digest
+
+    for path in candidates:
+        if digests[(0, path)] != digests[(1, path)]:
+            mismatches.append((path, "content differs"))
+
+    cache_a.save()
+    cache_b.save()
+    mismatches.sort()
+    return mismatches